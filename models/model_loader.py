@@ -23,6 +23,37 @@ MODEL_ZOO = {
     'vit-b-16': (models.vit_b_16, ViT_B_16_Weights.IMAGENET1K_V1)  # Vision Transformer
 }
 
+# Convolutional architectures that run faster in the channels_last memory format
+# (attention models such as ViT and Swin see no benefit)
+CHANNELS_LAST_MODELS = (
+    models.ResNet, models.ConvNeXt, models.EfficientNet,
+    models.DenseNet, models.MobileNetV3, models.RegNet
+)
+
+def uses_channels_last(model):
+    """
+    Check whether a model should run with channels_last inputs and weights.
+    
+    Parameters:
+    - model: Pretrained model (optionally wrapped by torch.compile).
+    
+    Returns:
+    - True for convolutional architectures listed in CHANNELS_LAST_MODELS.
+    """
+    return isinstance(getattr(model, "_orig_mod", model), CHANNELS_LAST_MODELS)
+
+def input_memory_format(model):
+    """
+    Memory format that all inputs of a model should use, so compiled models see a single layout.
+    
+    Parameters:
+    - model: Pretrained model (optionally wrapped by torch.compile).
+    
+    Returns:
+    - torch.channels_last for models in CHANNELS_LAST_MODELS, otherwise torch.contiguous_format.
+    """
+    return torch.channels_last if uses_channels_last(model) else torch.contiguous_format
+
 def load_model(model_name='resnet50', device=None):
     """
     Load a pretrained model based on the model name, using updated weights parameter.
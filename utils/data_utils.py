@@ -14,4 +14,32 @@ def process_data_tuple(data_tuple, model):
     """
     image, label = data_tuple
     image = image.to(next(model.parameters()).device)
-    return image, label
\ No newline at end of file
+    return image, label
+
+
+def batch_data_tuples(data_source, model, batch_size):
+    """
+    Group data tuples (image, label) into batches of images on the model's device.
+
+    Parameters:
+    - data_source: DataLoader or list of tuples (image, label).
+    - model: The model to determine the device.
+    - batch_size: Number of images to group into one batch.
+
+    Yields:
+    - images: Image tensors of the grouped items concatenated along the batch dimension.
+    - labels: List of labels of the grouped items (unchanged).
+    """
+    images, labels = [], []
+    num_images = 0
+    for data_tuple in data_source:
+        image, label = process_data_tuple(data_tuple, model)
+        images.append(image)
+        labels.append(label)
+        num_images += image.shape[0]
+        if num_images >= batch_size:
+            yield torch.cat(images), labels
+            images, labels = [], []
+            num_images = 0
+    if images:
+        yield torch.cat(images), labels
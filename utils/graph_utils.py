@@ -0,0 +1,91 @@
+import torch
+
+def capture_cuda_graph(model, example_input, warmup_iters=3, autocast_dtype=None):
+    """
+    Capture the inference forward pass of a model in a CUDA Graph.
+
+    Parameters:
+    - model: Model in eval mode on a CUDA device.
+    - example_input: Input tensor whose shape, dtype and device define the static input buffer.
+    - warmup_iters: Number of warm-up forwards run on a side stream before capture (default: 3).
+    - autocast_dtype: Optional reduced precision dtype (e.g. torch.bfloat16) to capture the
+      forward under torch.autocast; replays keep the captured precision.
+
+    Returns:
+    - graphed_forward: Callable that copies its input into the static buffer, replays the graph
+      and returns the static output tensor (overwritten by the next call).
+    """
+    static_input = torch.empty_like(example_input)
+    static_input.copy_(example_input)
+
+    # Warm up on a side stream so lazy initialisation (cuDNN autotune, allocator) is not captured
+    autocast = torch.autocast("cuda", dtype=autocast_dtype, enabled=autocast_dtype is not None)
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream), torch.inference_mode(), autocast:
+        for _ in range(warmup_iters):
+            model(static_input)
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.inference_mode(), autocast, torch.cuda.graph(graph):
+        static_output = model(static_input)
+
+    def graphed_forward(x):
+        static_input.copy_(x)
+        graph.replay()
+        return static_output
+
+    return graphed_forward
+
+
+def get_graphed_forward(model, example_input, cache, autocast_dtype=None):
+    """
+    Return a cached CUDA Graph forward for the model and input shape, capturing it on first use.
+    Models returned by torch.compile are returned unchanged.
+
+    Parameters:
+    - model: Model in eval mode on a CUDA device.
+    - example_input: Input tensor with the static shape to capture.
+    - cache: weakref.WeakKeyDictionary mapping each model to a dictionary of captured forwards
+      keyed by (input shape, autocast dtype). Entries (and their graph memory) are released
+      together with the model, so a new model can never replay a graph of a freed one.
+    - autocast_dtype: Optional reduced precision dtype passed to capture_cuda_graph.
+
+    Returns:
+    - graphed_forward: Callable returned by capture_cuda_graph (or the compiled model itself).
+    """
+    # Compiled models (mode="reduce-overhead") already record and replay CUDA Graphs themselves
+    if hasattr(model, "_orig_mod"):
+        return model
+
+    model_cache = cache.setdefault(model, {})
+    key = (tuple(example_input.shape), autocast_dtype)
+    if key not in model_cache:
+        model_cache[key] = capture_cuda_graph(model, example_input, autocast_dtype=autocast_dtype)
+    return model_cache[key]
+
+
+def compile_model(model, example_input, mode="reduce-overhead", warmup_iters=3):
+    """
+    Compile a model with torch.compile and run warm-up forwards so compilation and
+    CUDA Graph recording happen before any timed call.
+
+    Parameters:
+    - model: Model in eval mode.
+    - example_input: Input tensor with the shape used for inference.
+    - mode: torch.compile mode (default: "reduce-overhead").
+    - warmup_iters: Number of forwards run after compiling (default: 3).
+
+    Returns:
+    - The compiled model, or the original model if compilation is not supported on this platform.
+    """
+    try:
+        compiled_model = torch.compile(model, mode=mode, fullgraph=False)
+        with torch.inference_mode():
+            for _ in range(warmup_iters):
+                compiled_model(example_input)
+    except Exception as e:
+        print(f"Warning: torch.compile failed ({e}). Using the eager model.")
+        return model
+    return compiled_model
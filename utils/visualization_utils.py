@@ -0,0 +1,133 @@
+import cv2
+import numpy as np
+import torch
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# JET colormap lookup table (256 x 3, same channel order as cv2.applyColorMap)
+JET_LUT = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_JET).reshape(256, 3)
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True, inline="always")
+    def _cubic_weights(t):
+        """
+        Bicubic convolution weights (A = -0.75, as used by cv2.INTER_CUBIC) for the four taps
+        around a source coordinate with fractional part t.
+        """
+        A = -0.75
+        w0 = ((A * (t + 1) - 5 * A) * (t + 1) + 8 * A) * (t + 1) - 4 * A
+        w1 = ((A + 2) * t - (A + 3)) * t * t + 1
+        w2 = ((A + 2) * (1 - t) - (A + 3)) * (1 - t) * (1 - t) + 1
+        return w0, w1, w2, 1.0 - w0 - w1 - w2
+
+    @njit(cache=True, parallel=True)
+    def _prep_overlay(attr, mean, std, img, lut, normalize, img_out, out):
+        """
+        Fused heatmap overlay: clamp, normalize, bicubically upsample the attribution to the image
+        size (like cv2.resize with INTER_CUBIC), apply the colormap, denormalize the image and
+        blend (0.6 image, 0.4 heatmap).
+        """
+        h, w = attr.shape
+        H, W = img.shape[0], img.shape[1]
+
+        scale = 1.0
+        if normalize:
+            attr_max = 0.0
+            for i in range(h):
+                for j in range(w):
+                    if attr[i, j] > attr_max:
+                        attr_max = attr[i, j]
+            scale = 1.0 / attr_max if attr_max > 0 else 0.0
+
+        for y in prange(H):
+            # Source coordinates follow the half-pixel convention of cv2.resize (border replicated)
+            fy = (y + 0.5) * h / H - 0.5
+            sy = int(np.floor(fy))
+            wy = _cubic_weights(fy - sy)
+            for x in range(W):
+                fx = (x + 0.5) * w / W - 0.5
+                sx = int(np.floor(fx))
+                wx = _cubic_weights(fx - sx)
+
+                a = 0.0
+                for i in range(4):
+                    yi = min(max(sy - 1 + i, 0), h - 1)
+                    row = 0.0
+                    for j in range(4):
+                        xj = min(max(sx - 1 + j, 0), w - 1)
+                        row += wx[j] * max(attr[yi, xj], 0.0)
+                    a += wy[i] * row
+                # Cubic interpolation can overshoot, so clip back to [0, 1]
+                idx = int(min(max(a * scale, 0.0), 1.0) * 255)
+
+                for c in range(3):
+                    v = min(max((img[y, x, c] * std[c] + mean[c]) * 255, 0.0), 255.0)
+                    pixel = np.uint8(v)
+                    img_out[y, x, c] = pixel
+                    out[y, x, c] = np.uint8(min(0.6 * pixel + 0.4 * lut[idx, c] + 0.5, 255.0))
+
+
+def fused_overlay(attribution, img, normalize=True):
+    """
+    Build the denormalized image and the heatmap overlay in a single Numba pass.
+
+    Parameters:
+    - attribution: Float array (any resolution) with the attribution map; 1D maps (e.g. from
+      transformer layers) are treated as a single row, as cv2.resize does.
+    - img: Normalized image as an (H, W, 3) float array.
+    - normalize: Whether to clamp at zero and divide the attribution by its maximum.
+
+    Returns:
+    - img_np: Denormalized uint8 image (H, W, 3).
+    - overlayed_img: uint8 blend of the image and the colored heatmap (H, W, 3).
+    """
+    H, W = img.shape[0], img.shape[1]
+    img_np = np.empty((H, W, 3), dtype=np.uint8)
+    overlayed_img = np.empty((H, W, 3), dtype=np.uint8)
+    attribution = np.atleast_2d(attribution.astype(np.float32, copy=False))
+    _prep_overlay(attribution, IMAGENET_MEAN, IMAGENET_STD,
+                  img.astype(np.float32, copy=False), JET_LUT, normalize, img_np, overlayed_img)
+    return img_np, overlayed_img
+
+
+def gpu_overlay(attribution, image):
+    """
+    Build the denormalized image and the heatmap overlay on the attribution's device using a
+    JET lookup table, transferring only the final uint8 arrays to the host.
+
+    Parameters:
+    - attribution: 2D tensor with values in [0, 1] at the image resolution.
+    - image: Normalized image tensor (shape: [1, 3, H, W]).
+
+    Returns:
+    - img_np: Denormalized uint8 image (H, W, 3).
+    - overlayed_img: uint8 blend of the image and the colored heatmap (H, W, 3).
+    """
+    device = attribution.device
+    if device not in gpu_overlay.constants:
+        gpu_overlay.constants[device] = (
+            torch.from_numpy(JET_LUT).to(device),
+            torch.from_numpy(IMAGENET_MEAN).to(device),
+            torch.from_numpy(IMAGENET_STD).to(device),
+        )
+    lut, mean, std = gpu_overlay.constants[device]
+
+    colored = lut[(attribution.clamp(0, 1) * 255).long()]  # shape: [H, W, 3]
+    img = image.squeeze(0).permute(1, 2, 0)
+    img = ((img * std + mean) * 255).clamp(0, 255).to(torch.uint8)
+    overlay = (0.6 * img.float() + 0.4 * colored.float() + 0.5).clamp(0, 255).to(torch.uint8)
+
+    img_np, overlayed_img = torch.stack((img, overlay)).cpu().numpy()
+    return img_np, overlayed_img
+
+
+# Lookup table and normalization constants per device
+gpu_overlay.constants = {}
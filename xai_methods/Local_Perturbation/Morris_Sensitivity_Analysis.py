@@ -1,25 +1,58 @@
 import torch
-import torch.nn.functional as F
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 import timeit
-from utils.data_utils import process_data_tuple
+import weakref
+from utils.data_utils import batch_data_tuples
+from utils.graph_utils import compile_model, get_graphed_forward
+from utils.visualization_utils import IMAGENET_MEAN, IMAGENET_STD, NUMBA_AVAILABLE, fused_overlay, gpu_overlay
 from models.label_utils import get_label_mapping
+from models.model_loader import input_memory_format, uses_channels_last
 
-def generate_attribution(image, predicted_class, model, patch_size=16, num_samples=10, delta=0.05):
+def get_amp_dtype(device, use_amp=False):
+    """
+    Select the reduced precision dtype for Morris forwards.
+    Reduced precision degrades the attribution: bfloat16 logits are only precise to a few
+    hundredths, which is comparable to or larger than the effect of a delta on one patch.
+    
+    Parameters:
+    - device: Device the model runs on.
+    - use_amp: Whether reduced precision is allowed (default: False).
+    
+    Returns:
+    - torch.bfloat16 on CUDA GPUs with native bfloat16 support (compute capability 8.0 or
+      newer) when use_amp is set, otherwise None.
+    """
+    if use_amp and device.type == "cuda" and torch.cuda.get_device_capability(device)[0] >= 8:
+        return torch.bfloat16
+    return None
+
+
+def generate_attribution(image, predicted_class, model, patch_size=16, num_samples=10, delta=0.05, batch_size=64,
+                         use_amp=False):
     """
     Generate Morris Sensitivity Analysis (MSA) attribution for the given image and class.
     This method perturbs small patches of the input by adding a small delta and computes the change 
     in the predicted probability to estimate the sensitivity of each patch.
+    All patch perturbations are stacked into a batch and evaluated in chunks of `batch_size`.
+    On CUDA the batched forward is captured once in a CUDA Graph and replayed for every chunk,
+    and forwards can optionally run under bfloat16 autocast.
     
     Parameters:
     - image: Tensor representing the input image (shape: [1, 3, H, W]).
     - predicted_class: Predicted class label for which we compute the attribution.
     - model: Pretrained model.
     - patch_size: Size of the patch to perturb (default: 16).
-    - num_samples: Number of perturbations to average per patch.
+    - num_samples: Number of perturbations to average per patch. Has no effect: the delta is
+      deterministic, so every sample of a patch gives the same effect and each patch is
+      evaluated once. Kept for backward compatibility.
     - delta: The small additive perturbation value.
+    - batch_size: Number of perturbed images evaluated per forward pass (default: 64).
+      On CUDA it is rounded up to a power of two and the final chunk is padded.
+    - use_amp: Run the forwards in bfloat16 autocast on CUDA GPUs with native bfloat16 support
+      (default: False). Faster, but rounding noise in the logits swamps many patch effects, so
+      the heatmap no longer matches the FP32 result.
     
     Returns:
     - heatmap: A 2D tensor (upsampled to input size) representing the sensitivity of each region.
@@ -27,41 +60,108 @@ def generate_attribution(image, predicted_class, model, patch_size=16, num_sampl
     model.eval()
     device = image.device
 
-    # Get the original predicted probability for the target class
-    with torch.no_grad():
-        output = model(image)
-        orig_prob = F.softmax(output, dim=1)[0, predicted_class.item()]
-    
+    # Channels-last inputs for convolutional models (weights are converted once in warm_up)
+    memory_format = input_memory_format(model)
+    image = image.contiguous(memory_format=memory_format)
+
+    # Reduced precision forwards; probabilities are still computed in FP32 from the logits
+    amp_dtype = get_amp_dtype(device, use_amp)
+    autocast = torch.autocast(device.type, dtype=amp_dtype or torch.bfloat16, enabled=amp_dtype is not None)
+
+    # Keep the class index on device and gather with it, avoiding a host sync through .item()
+    cls_idx = torch.as_tensor(predicted_class, device=device).view(1, 1)
+
     # Get image spatial dimensions
     _, _, H, W = image.shape
     num_patches_h = H // patch_size
     num_patches_w = W // patch_size
+    num_patches = num_patches_h * num_patches_w
+
+    # The perturbation is a fixed additive delta, so every sample of a patch produces the
+    # same effect. Evaluating each patch once yields the identical average over num_samples.
+
+    # On CUDA, replay a CUDA Graph with a fixed (power of two) batch size instead of eager forwards.
+    # One extra row is kept for the unperturbed image, whose probability is the reference.
+    batch_size = min(batch_size, num_patches + 1)
+    use_graph = device.type == "cuda"
+    if use_graph:
+        batch_size = 1 << (batch_size - 1).bit_length()
+
+    # Persistent buffers: a zero additive mask holding one delta patch per batch element,
+    # and the perturbed batch it is added into. Only patch regions are written per chunk.
+    # On CUDA two perturbed batches are used, so the next chunk is built on a side stream
+    # while the model runs on the current one.
+    prep_stream = torch.cuda.Stream() if device.type == "cuda" else None
+    mask_batch = torch.empty(
+        (batch_size,) + tuple(image.shape[1:]), device=device, dtype=image.dtype, memory_format=memory_format
+    ).zero_()
+    perturbed_buffers = [torch.empty_like(mask_batch) for _ in range(2 if prep_stream is not None else 1)]
+    mask_patches = mask_batch[:, :, :num_patches_h * patch_size, :num_patches_w * patch_size].view(
+        batch_size, -1, num_patches_h, patch_size, num_patches_w, patch_size
+    )
+
+    # The mask batch doubles as the example input (shape and memory format) for the graph lookup
+    forward = model
+    if use_graph:
+        forward = get_graphed_forward(model, mask_batch, generate_attribution.graph_cache, amp_dtype)
 
-    # Prepare an empty heatmap (one value per patch)
-    heatmap = torch.zeros((num_patches_h, num_patches_w), device=device)
-
-    # Iterate over patches
-    for i in range(num_patches_h):
-        for j in range(num_patches_w):
-            effects = []
-            for s in range(num_samples):
-                # Clone the original image to create a perturbed version
-                perturbed_image = image.clone()
-                
-                # Add a small perturbation (delta) to the current patch region
-                perturbed_image[:, :, i*patch_size:(i+1)*patch_size, j*patch_size:(j+1)*patch_size] += delta
-                
-                # Compute the model's output for the perturbed image
-                with torch.no_grad():
-                    out = model(perturbed_image)
-                    new_prob = F.softmax(out, dim=1)[0, predicted_class.item()]
-                
-                # Compute the elementary effect for this patch perturbation
-                effect = (new_prob - orig_prob) / delta
-                effects.append(effect.item())
-            
-            # Average the effect over the number of samples for this patch
-            heatmap[i, j] = sum(effects) / len(effects)
+    # Chunk layout (patch rows/columns per chunk) is specialized once per shape and reused
+    chunks = patch_chunk_plan(num_patches_h, num_patches_w, batch_size, device)
+    ready_events = [None] * len(chunks)  # Chunk built (recorded on the side stream)
+    free_events = [None] * len(perturbed_buffers)  # Buffer consumed by the model (current stream)
+
+    def prepare_chunk(k):
+        # Add a small perturbation (delta) to exactly one patch region per batch element
+        _, _, chunk_indices, rows, cols = chunks[k]
+        buffer_idx = k % len(perturbed_buffers)
+        with torch.cuda.stream(prep_stream):  # No-op when prep_stream is None
+            if free_events[buffer_idx] is not None:
+                prep_stream.wait_event(free_events[buffer_idx])
+            mask_patches[chunk_indices, :, rows, :, cols, :] = delta
+            torch.add(image, mask_batch, out=perturbed_buffers[buffer_idx])
+            mask_patches[chunk_indices, :, rows, :, cols, :] = 0
+            if prep_stream is not None:
+                ready_events[k] = torch.cuda.Event()
+                ready_events[k].record(prep_stream)
+
+    if prep_stream is not None:
+        prep_stream.wait_stream(torch.cuda.current_stream())
+
+    # Compute the target class probability for every patch perturbation, one chunk of patches at a
+    # time, written straight into a preallocated tensor. The final chunk always has an unperturbed
+    # padding row (mask is zero there); it is evaluated with the final chunk and stored last.
+    # On CUDA every chunk replays the same fixed-size graph, so the reference has exactly the
+    # numerics of the perturbed rows. Eager forwards (CPU) run the final chunk at a smaller batch,
+    # which can differ from the full batches by batch-size dependent rounding.
+    probs = torch.empty(num_patches + 1, device=device)
+    prepare_chunk(0)
+    for k, (start, num_chunk, _, _, _) in enumerate(chunks):
+        buffer_idx = k % len(perturbed_buffers)
+        perturbed_images = perturbed_buffers[buffer_idx]
+        if prep_stream is not None:
+            # Build the next chunk on the side stream, then wait until this one is ready
+            if k + 1 < len(chunks):
+                prepare_chunk(k + 1)
+            torch.cuda.current_stream().wait_event(ready_events[k])
+
+        # Compute the model's output for the perturbed batch (remaining padding rows are discarded);
+        # exp(logit - logsumexp) gives the softmax entry without materializing the full softmax
+        num_rows = num_chunk + 1 if k == len(chunks) - 1 else num_chunk
+        with torch.inference_mode(), autocast:
+            out = forward(perturbed_images if use_graph else perturbed_images[:num_rows])[:num_rows].float()
+            probs[start:start + num_rows] = torch.exp(
+                out.gather(1, cls_idx.expand(num_rows, 1)).squeeze(1) - torch.logsumexp(out, dim=1)
+            )
+
+        if prep_stream is not None:
+            free_events[buffer_idx] = torch.cuda.Event()
+            free_events[buffer_idx].record()
+        elif k + 1 < len(chunks):
+            prepare_chunk(k + 1)
+
+    # Elementary effect of each patch relative to the unperturbed probability
+    effects = (probs[:num_patches] - probs[num_patches]) / delta
+    heatmap = effects.view(num_patches_h, num_patches_w)
     
     # Use the absolute value of the sensitivity and normalize for visualization
     heatmap = torch.abs(heatmap)
@@ -73,26 +173,116 @@ def generate_attribution(image, predicted_class, model, patch_size=16, num_sampl
     else:
         heatmap.zero_()
     
-    # Upsample the heatmap to match the input image size
-    heatmap = heatmap.unsqueeze(0).unsqueeze(0)  # shape: [1, 1, num_patches_h, num_patches_w]
-    heatmap = F.interpolate(heatmap, size=(H, W), mode='bilinear', align_corners=False)
-    heatmap = heatmap.squeeze()  # shape: [H, W]
+    # Upsample the heatmap to match the input image size (separable bilinear: U_h @ heatmap @ U_w^T)
+    upsample_h = bilinear_upsample_matrix(num_patches_h, H, device, heatmap.dtype)
+    upsample_w = bilinear_upsample_matrix(num_patches_w, W, device, heatmap.dtype)
+    heatmap = upsample_h @ heatmap @ upsample_w.T  # shape: [H, W]
     
     return heatmap
 
 
+# Cache of captured CUDA Graph forwards, per model (weakly referenced) and input shape
+generate_attribution.graph_cache = weakref.WeakKeyDictionary()
+
+
+def patch_chunk_plan(num_patches_h, num_patches_w, batch_size, device):
+    """
+    Precompute how the patch grid is split into chunks of perturbed images.
+    Plans are cached per (grid, batch size, device), so repeated attributions at the same
+    (patch_size, H, W) reuse the index tensors instead of recomputing them every chunk.
+    The final chunk always leaves at least one batch row unperturbed (an empty chunk is
+    appended when the patches fill every chunk exactly).
+    
+    Parameters:
+    - num_patches_h: Number of patches along the image height.
+    - num_patches_w: Number of patches along the image width.
+    - batch_size: Number of perturbed images per chunk.
+    - device: Device of the index tensors.
+    
+    Returns:
+    - chunks: List of (start, num_chunk, chunk_indices, rows, cols) tuples, where chunk_indices
+      are the batch positions and rows/cols the patch coordinates perturbed in each chunk.
+    """
+    key = (num_patches_h, num_patches_w, batch_size, device)
+    if key not in patch_chunk_plan.cache:
+        num_patches = num_patches_h * num_patches_w
+        patch_indices = torch.arange(num_patches, device=device)
+        batch_indices = torch.arange(batch_size, device=device)
+        chunks = []
+        for start in range(0, num_patches, batch_size):
+            chunk = patch_indices[start:start + batch_size]
+            chunks.append((start, len(chunk), batch_indices[:len(chunk)],
+                           chunk // num_patches_w, chunk % num_patches_w))
+        if num_patches % batch_size == 0:
+            empty = patch_indices[:0]
+            chunks.append((num_patches, 0, empty, empty, empty))
+        patch_chunk_plan.cache[key] = chunks
+    return patch_chunk_plan.cache[key]
+
+
+# Cache of chunk plans, keyed by (num_patches_h, num_patches_w, batch_size, device)
+patch_chunk_plan.cache = {}
+
+
+def bilinear_upsample_matrix(in_size, out_size, device, dtype=torch.float32):
+    """
+    Build the 1D bilinear interpolation matrix used to upsample a heatmap along one axis.
+    Matches F.interpolate(mode='bilinear', align_corners=False); matrices are cached per size.
+    
+    Parameters:
+    - in_size: Number of input samples (patches) along the axis.
+    - out_size: Number of output samples (pixels) along the axis.
+    - device: Device of the matrix.
+    - dtype: Data type of the matrix (default: torch.float32).
+    
+    Returns:
+    - weights: Tensor of shape [out_size, in_size] with at most two nonzero entries per row.
+    """
+    key = (in_size, out_size, device, dtype)
+    if key not in bilinear_upsample_matrix.cache:
+        # Source coordinate of each output pixel centre
+        src = ((torch.arange(out_size, dtype=torch.float64) + 0.5) * (in_size / out_size) - 0.5).clamp(min=0)
+        idx0 = src.floor().long().clamp(max=in_size - 1)
+        idx1 = (idx0 + 1).clamp(max=in_size - 1)
+        frac = src - idx0
+        
+        weights = torch.zeros((out_size, in_size), dtype=torch.float64)
+        rows = torch.arange(out_size)
+        weights.index_put_((rows, idx0), 1 - frac, accumulate=True)
+        weights.index_put_((rows, idx1), frac, accumulate=True)
+        bilinear_upsample_matrix.cache[key] = weights.to(device=device, dtype=dtype)
+    return bilinear_upsample_matrix.cache[key]
+
+
+# Cache of interpolation matrices, keyed by (in_size, out_size, device, dtype)
+bilinear_upsample_matrix.cache = {}
+
+
 def warm_up(model):
     """
     Run a warm-up pass to ensure memory and computation stability.
+    The model is compiled with torch.compile(mode="reduce-overhead"), and both the compiled
+    model and the model passed in are warmed up (including the CUDA Graph capture used by
+    the eager model), so callers that ignore the return value also time warm attributions.
     
     Parameters:
     - model: Pretrained model.
+    
+    Returns:
+    - model: Compiled model to use for subsequent attribution calls (faster than the original).
     """
+    model.eval()
+    if uses_channels_last(model):
+        model = model.to(memory_format=torch.channels_last)
     dummy_image = torch.randn(1, 3, 224, 224, device=next(model.parameters()).device)
-    with torch.no_grad():
-        output = model(dummy_image)
-        _, predicted_class = torch.max(output, 1)
-    _ = generate_attribution(dummy_image, predicted_class, model)
+    dummy_image = dummy_image.contiguous(memory_format=input_memory_format(model))
+    compiled_model = compile_model(model, dummy_image)
+    for warm_model in ([compiled_model] if compiled_model is model else [compiled_model, model]):
+        with torch.inference_mode():
+            output = warm_model(dummy_image)
+            _, predicted_class = torch.max(output, 1)
+        _ = generate_attribution(dummy_image, predicted_class, warm_model)
+    return compiled_model
 
 
 def visualize_attribution(image, attribution, label, label_names, model, model_name, save_path=None):
@@ -108,8 +298,8 @@ def visualize_attribution(image, attribution, label, label_names, model, model_n
     - model_name: Name of the model.
     - save_path: Optional file path to save the visualization.
     """
-    with torch.no_grad():
-        output = model(image)
+    with torch.inference_mode():
+        output = model(image.contiguous(memory_format=input_memory_format(model)))
         _, predicted_class = torch.max(output, 1)
     
     # Get label mappings for predicted and true labels
@@ -122,20 +312,35 @@ def visualize_attribution(image, attribution, label, label_names, model, model_n
     
     print(f"Model: {model_name}, Predicted Class: {predicted_label}, True Class: {true_label}")
     
-    # Process the heatmap for visualization
-    heatmap_np = attribution.cpu().numpy()
-    heatmap_np = (heatmap_np * 255).astype(np.uint8)
-    heatmap_colored = cv2.applyColorMap(heatmap_np, cv2.COLORMAP_JET)
-    
-    # Convert the original image to a NumPy array (reverse normalization if needed)
-    img_np = image.squeeze().permute(1, 2, 0).cpu().numpy()
-    img_np = np.clip((img_np * [0.229, 0.224, 0.225] + [0.485, 0.456, 0.406]) * 255, 0, 255).astype(np.uint8)
-    
-    # Overlay the heatmap on the original image
-    overlayed_img = cv2.addWeighted(img_np, 0.6, heatmap_colored, 0.4, 0)
+    if attribution.is_cuda:
+        # Colorize, reverse normalization and blend on the GPU (heatmap is already in [0, 1])
+        img_np, overlayed_img = gpu_overlay(attribution, image)
+    elif NUMBA_AVAILABLE:
+        # Colorize, reverse normalization and blend in a single fused pass (heatmap is already in [0, 1])
+        img_np, overlayed_img = fused_overlay(attribution.cpu().numpy(), image.squeeze().permute(1, 2, 0).cpu().numpy(), normalize=False)
+    else:
+        # Process the heatmap for visualization
+        heatmap_np = attribution.cpu().numpy()
+        heatmap_np = (heatmap_np * 255).astype(np.uint8)
+        heatmap_colored = cv2.applyColorMap(heatmap_np, cv2.COLORMAP_JET)
+        
+        # Convert the original image to a NumPy array (reverse normalization if needed)
+        img_np = image.squeeze().permute(1, 2, 0).cpu().numpy()
+        img_np = np.clip((img_np * IMAGENET_STD + IMAGENET_MEAN) * 255, 0, 255).astype(np.uint8)
+        
+        # Overlay the heatmap on the original image
+        overlayed_img = cv2.addWeighted(img_np, 0.6, heatmap_colored, 0.4, 0)
     
-    # Plot the results
-    fig, axes = plt.subplots(1, 2, figsize=(10, 5))
+    # Plot the results, reusing the previous figure while it is still open
+    # (inline backends close figures on show, in which case a new one is created)
+    fig = visualize_attribution.figure
+    if fig is None or not plt.fignum_exists(fig.number):
+        fig, axes = plt.subplots(1, 2, figsize=(10, 5))
+        visualize_attribution.figure = fig
+    else:
+        axes = fig.axes
+        for ax in axes:
+            ax.clear()
     axes[0].imshow(img_np)
     title_input = f'Input' if true_label == "Unknown" else f'True: {true_label}'
     axes[0].set_title(title_input)
@@ -153,39 +358,67 @@ def visualize_attribution(image, attribution, label, label_names, model, model_n
         print(f"Saved visualization at {save_path}")
     
     plt.show()
-    plt.close(fig)
 
 
 # Initialize the save counter as an attribute of the function
 visualize_attribution.save_count = 0
+# Figure reused across visualization calls
+visualize_attribution.figure = None
 
 
-def measure_avg_time_across_images(data_source, model, generate_attribution):
+def measure_avg_time_across_images(data_source, model, generate_attribution, batch_size=16):
     """
     Measure the average time taken to generate Morris Sensitivity Analysis attributions across images.
+    Predicted classes are computed for `batch_size` images at a time; attributions are timed per image.
     
     Parameters:
     - data_source: DataLoader or list of image tuples.
     - model: Pretrained model.
     - generate_attribution: Function to generate attributions.
+    - batch_size: Number of images per prediction forward pass (default: 16).
     
     Returns:
     - avg_time_taken: Average time taken.
     - times: List of times for each image.
     """
+    device = next(model.parameters()).device
+
+    # On GPU, time with CUDA events (read back after a single synchronize at the end)
+    use_cuda_events = device.type == "cuda"
+    if use_cuda_events:
+        torch.cuda.empty_cache()
     times = []
-    for data_item in data_source:
-        image, label = process_data_tuple(data_item, model)
-        with torch.no_grad():
-            output = model(image)
-            _, predicted_class = torch.max(output, 1)
-        
-        start_time = timeit.default_timer()
-        _ = generate_attribution(image, predicted_class, model)
-        end_time = timeit.default_timer()
+    timing_events = []
+    for images, labels in batch_data_tuples(data_source, model, batch_size):
+        images = images.contiguous(memory_format=input_memory_format(model))
+        forward = model
+        if images.device.type == "cuda":
+            forward = get_graphed_forward(model, images, measure_avg_time_across_images.graph_cache)
+        with torch.inference_mode():
+            _, predicted_classes = torch.max(forward(images), 1)
         
-        times.append(end_time - start_time)
-        torch.cuda.empty_cache()
+        for image, predicted_class in zip(images.split(1), predicted_classes.split(1)):
+            if use_cuda_events:
+                start_event = torch.cuda.Event(enable_timing=True)
+                end_event = torch.cuda.Event(enable_timing=True)
+                start_event.record()
+                _ = generate_attribution(image, predicted_class, model)
+                end_event.record()
+                timing_events.append((start_event, end_event))
+            else:
+                start_time = timeit.default_timer()
+                _ = generate_attribution(image, predicted_class, model)
+                end_time = timeit.default_timer()
+                times.append(end_time - start_time)
+    
+    # Event timings are in milliseconds; convert to seconds like the CPU path
+    if use_cuda_events:
+        torch.cuda.synchronize()
+        times = [start_event.elapsed_time(end_event) / 1000 for start_event, end_event in timing_events]
     
     avg_time_taken = sum(times) / len(times)
     return avg_time_taken, times
+
+
+# Cache of captured CUDA Graph prediction forwards, per model (weakly referenced) and input shape
+measure_avg_time_across_images.graph_cache = weakref.WeakKeyDictionary()